@@ -11,12 +11,14 @@ import fcntl
 import subprocess  # Нужно для управления WARP
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional
 
 import requests
 from bs4 import BeautifulSoup
 from curl_cffi import requests as cffi_requests, CurlHttpVersion
 
+from posted_state import load_posted_ids
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 # --- КОНФИГУРАЦИЯ ---
@@ -27,6 +29,9 @@ BASE_DELAY = 1.0
 FETCH_DEPTH = 30
 SCRAPER_TIMEOUT = 60
 BAD_RE = re.compile(r"[\u200b-\u200f\uFEFF\u200E\u00A0]")
+TAG_RE = re.compile(r"<[^>]+>")
+MULTI_NL_RE = re.compile(r"\n{3,}")
+SRCSET_RE = re.compile(r"(\S+)\s+(\d+)w")
 
 # Константа для порта WARP (Socks5 с удаленным DNS)
 WARP_PROXY = "socks5h://127.0.0.1:40000"
@@ -141,17 +146,8 @@ def translate_text(text: str, to_lang: str = "ru") -> str:
 def sanitize_text(text: str) -> str:
     if not text: return ""
     text = html.unescape(text)
-    text = re.sub(r'<[^>]+>', '', text)
-    return re.sub(r'\n{3,}', '\n\n', text).strip()
-
-def load_posted_ids(state_file_path: Path) -> Set[str]:
-    try:
-        if state_file_path.exists():
-            with open(state_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return {str(item) for item in data}
-        return set()
-    except Exception: return set()
+    text = TAG_RE.sub('', text)
+    return MULTI_NL_RE.sub('\n\n', text).strip()
 
 def load_stopwords(file_path: Optional[Path]) -> List[str]:
     if not file_path or not file_path.exists(): return []
@@ -167,7 +163,7 @@ def extract_img_url(img_tag: Any) -> Optional[str]:
             parts = srcset.split(',')
             links = []
             for p in parts:
-                match = re.search(r'(\S+)\s+(\d+)w', p.strip())
+                match = SRCSET_RE.search(p.strip())
                 if match: links.append((int(match.group(2)), match.group(1)))
             if links: return sorted(links, key=lambda x: x[0], reverse=True)[0][1].split('?')[0]
         except: pass
@@ -366,7 +362,7 @@ def main():
         posted = load_posted_ids(Path(args.posted_state_file))
         stop = load_stopwords(Path(args.stopwords_file))
         
-        new_posts = [p for p in posts if str(p["id"]) not in posted]
+        new_posts = [p for p in posts if int(p["id"]) not in posted]
         logging.info(f"Total: {len(posts)}, New: {len(new_posts)}")
 
         if not new_posts:
@@ -0,0 +1,95 @@
+# Общее состояние парсера (main.py) и постера (poster.py): ID уже опубликованных статей
+import heapq
+import logging
+import os
+from pathlib import Path
+from typing import Iterable, Set
+
+import orjson
+
+# Лимит записей в истории (храним 500 последних для защиты от дублей)
+MAX_POSTED_RECORDS = 500
+
+def _log_path(state_file: Path) -> Path:
+    """Журнал новых ID рядом со снимком: posted.json -> posted.log."""
+    return state_file.with_suffix(".log")
+
+def load_posted_ids(state_file: Path) -> Set[int]:
+    """Снимок posted.json + ID, дописанные в журнал после него."""
+    ids: Set[int] = set()
+    try:
+        if state_file.is_file():
+            data = orjson.loads(state_file.read_bytes())
+            if isinstance(data, list):
+                ids.update(int(item) for item in data if item is not None)
+    except Exception: pass
+    try:
+        log_file = _log_path(state_file)
+        if log_file.is_file():
+            # Берем только строки с "\n" на конце: оборванная при сбое последняя строка
+            # (например, "123" вместо "1234\n") не должна засчитаться чужим ID
+            lines = log_file.read_text(encoding="utf-8").split("\n")[:-1]
+            ids.update(int(line) for line in map(str.strip, lines) if line.isdigit())
+    except Exception: pass
+    return ids
+
+def append_posted_ids(new_ids: Iterable[int], state_file: Path) -> None:
+    """Дописывает ID в журнал: O(новых ID) вместо перезаписи всей истории."""
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with _log_path(state_file).open("a+b") as f:
+            # Оборванную строку сначала закрываем, иначе новый ID склеится с ней и потеряется
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n": f.write(b"\n")
+            f.write("".join(f"{i}\n" for i in new_ids).encode())
+            # Запись должна пережить падение процесса сразу после публикации
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        logging.error(f"Ошибка при записи журнала posted.log: {e}")
+
+def compact_posted_ids(state_file: Path) -> None:
+    """Сворачивает журнал в posted.json, когда в нем больше MAX_POSTED_RECORDS строк."""
+    log_file = _log_path(state_file)
+    try:
+        if not log_file.is_file(): return
+        with log_file.open(encoding="utf-8") as f:
+            if sum(1 for _ in f) <= MAX_POSTED_RECORDS: return
+        # Журнал удаляем только после успешной записи снимка, иначе ID из него потеряются.
+        # Если упадем до unlink, ID просто продублируются в снимке и журнале
+        if not save_posted_ids(load_posted_ids(state_file), state_file): return
+        log_file.unlink()
+    except Exception as e:
+        logging.error(f"Ошибка при сжатии журнала posted.log: {e}")
+
+def save_posted_ids(all_ids_to_save: Set[int], state_file: Path) -> bool:
+    """Атомарно сохраняет ID в файл, обрезая историю до лимита. False — снимок не записан."""
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if len(all_ids_to_save) <= MAX_POSTED_RECORDS:
+            sorted_ids = sorted(all_ids_to_save)
+        else:
+            # Нужны только последние MAX_POSTED_RECORDS: частичный отбор вместо сортировки всего набора
+            sorted_ids = heapq.nlargest(MAX_POSTED_RECORDS, all_ids_to_save)
+            sorted_ids.sort()
+        
+        # Сохраняем через временный файл, чтобы не повредить основной при сбое
+        # (fsync до rename: иначе после сбоя на месте posted.json может оказаться пустой файл).
+        # Отступы оставляем: файл коммитится в git, и по ID на строку диффы остаются маленькими
+        temp_file = state_file.with_suffix(".tmp")
+        with temp_file.open("wb") as f:
+            f.write(orjson.dumps(sorted_ids, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        temp_file.replace(state_file)
+        # fsync каталога фиксирует сам rename
+        dir_fd = os.open(state_file.parent, os.O_RDONLY)
+        try: os.fsync(dir_fd)
+        finally: os.close(dir_fd)
+        
+        logging.info(f"💾 История обновлена: {len(sorted_ids)} ID сохранено.")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении posted.json: {e}")
+        return False
@@ -2,124 +2,302 @@ import os
 import json
 import argparse
 import asyncio
+import contextlib
 import logging
+import multiprocessing
+import random
 import re
+import functools
+import shutil
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Set, Tuple
-from io import BytesIO
 import httpx
-from httpx import HTTPStatusError, ReadTimeout, Timeout
+import orjson
+from httpx import HTTPStatusError, Limits, ReadTimeout, Timeout
 from PIL import Image
 
+from posted_state import append_posted_ids, compact_posted_ids, load_posted_ids
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 # --- КОНФИГУРАЦИЯ ---
-# Лимит записей в истории (храним 500 последних для защиты от дублей)
-MAX_POSTED_RECORDS = 500 
 WATERMARK_SCALE = 0.35
+WATERMARK_PATH = Path(__file__).parent / "watermark.png"
+# Знак декодируем один раз при импорте (в каждом процессе пула — тоже один раз); нет файла — шлем фото без знака
+try:
+    _WATERMARK_SRC: Optional[Image.Image] = Image.open(WATERMARK_PATH).convert("RGBA")
+except FileNotFoundError:
+    _WATERMARK_SRC = None
+except Exception as e:
+    logging.warning(f"Не удалось загрузить {WATERMARK_PATH.name}, фото пойдут без водяного знака: {e}")
+    _WATERMARK_SRC = None
+# Длинная сторона фото перед наложением знака: заметно меньше камерных 3000-6000px,
+# но без видимой потери качества в канале (Telegram хранит фото до 2560px)
+MAX_PHOTO_SIDE = 1600
+# Порог для JPEG draft(): декодируем с запасом, точный размер дает thumbnail()
+DRAFT_PHOTO_SIDE = 2048
+JPEG_QUALITY = 85
+# Формат фото для Telegram: JPEG (по умолчанию) или WEBP — файл меньше при том же качестве, заливка быстрее
+WATERMARK_FORMAT = os.getenv("WATERMARK_FORMAT", "JPEG").upper()
+WEBP_QUALITY = 82
+PHOTO_EXT, PHOTO_MIME = (".webp", "image/webp") if WATERMARK_FORMAT == "WEBP" else (".jpg", "image/jpeg")
 
+TELEGRAM_API = "https://api.telegram.org"
 # Увеличенные таймауты для стабильной работы через прокси/WARP
 HTTPX_TIMEOUT = Timeout(connect=30.0, read=60.0, write=120.0, pool=10.0)
+# Одно keep-alive соединение на весь запуск: TLS-рукопожатие не повторяется на каждый чанк.
+# keepalive_expiry больше паузы между статьями (POST_DELAY), иначе пул закрывает соединение в простое
+HTTPX_LIMITS = Limits(max_keepalive_connections=8, max_connections=8, keepalive_expiry=60.0)
+
+# Пул для наложения водяного знака: "thread" (декодирование, paste и JPEG в Pillow идут без GIL)
+# или "process" — чтобы сравнить на конкретной машине
+WATERMARK_EXECUTOR = os.getenv("WATERMARK_EXECUTOR", "thread")
+WATERMARK_WORKERS = min(10, os.cpu_count() or 1)
+# Потоки для параллельного чтения meta.json
+META_WORKERS = 32
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+
+# Лимиты Telegram: ~20 сообщений в минуту в один чат и ~30 в секунду на бота
+CHAT_RATE     = (20, 60.0)
+GLOBAL_RATE   = (30, 1.0)
 
 MAX_RETRIES   = 3
 RETRY_DELAY   = 5.0
+BACKOFF_CAP   = 60.0
 DEFAULT_DELAY = 10.0
 
+PARA_SPLIT_RE = re.compile(r"\n{2,}")
+LEADING_WS_RE = re.compile(r"\s*")
+# Кнопки под последним сообщением статьи — константа, сериализуем один раз
+# (без \uXXXX-экранирования: кириллица и эмодзи в форме заметно короче)
+REPLY_MARKUP_JSON = json.dumps({
+    "inline_keyboard": [[
+        {"text": "💵 Обмен валют", "url": "https://t.me/mister1dollar"},
+        {"text": "✍️ Отзывы", "url": "https://t.me/feedback1dollar"}
+    ]]
+}, ensure_ascii=False)
+HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
 def escape_html(text: str) -> str:
-    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+    return text.translate(HTML_ESCAPE_TABLE)
 
 def chunk_text(text: str, size: int = 4096) -> List[str]:
-    paras = [p for p in text.replace('\r\n', '\n').split('\n\n') if p.strip()]
-    chunks, current_chunk = [], ""
+    # CRLF приводим к \n до разбиения: переводы строк внутри абзаца тоже не должны уходить как \r\n
+    paras = [p for p in PARA_SPLIT_RE.split(text.replace("\r\n", "\n")) if p.strip()]
+    # Абзацы текущего чанка копим списком и склеиваем один раз при сбросе
+    chunks, current, current_len = [], [], 0
     for p in paras:
         if len(p) > size:
-            if current_chunk: chunks.append(current_chunk)
-            parts, sub_part = [], ""
+            if current: chunks.append("\n\n".join(current))
+            # Копим слова в списке и склеиваем один раз: без квадратичных конкатенаций
+            parts, words, words_len = [], [], 0
             for word in p.split():
-                if len(sub_part) + len(word) + 1 > size:
-                    parts.append(sub_part)
-                    sub_part = word
+                if words and words_len + len(word) + 1 > size:
+                    parts.append(" ".join(words))
+                    words, words_len = [word], len(word)
                 else:
-                    sub_part = f"{sub_part} {word}".lstrip()
-            if sub_part: parts.append(sub_part)
+                    words_len += len(word) + (1 if words else 0)
+                    words.append(word)
+            if words: parts.append(" ".join(words))
             chunks.extend(parts)
-            current_chunk = ""
+            current, current_len = [], 0
+        elif current and current_len + len(p) + 2 > size:
+            chunks.append("\n\n".join(current))
+            current, current_len = [p], len(p)
         else:
-            if not current_chunk: current_chunk = p
-            elif len(current_chunk) + len(p) + 2 <= size: current_chunk += f"\n\n{p}"
-            else:
-                chunks.append(current_chunk)
-                current_chunk = p
-    if current_chunk: chunks.append(current_chunk)
+            current_len += len(p) + (2 if current else 0)
+            current.append(p)
+    if current: chunks.append("\n\n".join(current))
     return chunks
 
-def apply_watermark(img_path: Path, scale: float) -> bytes:
+def _prepare_body(html_title: str, title: str, raw: str) -> str:
+    """Собирает HTML поста: заголовок + экранированный текст без дубля заголовка, за один проход."""
+    # Смещаемся по индексу вместо lstrip(), чтобы не копировать весь текст
+    start = LEADING_WS_RE.match(raw).end()
+    if raw.startswith(title, start):
+        start = LEADING_WS_RE.match(raw, start + len(title)).end()
+    # Лишние пустые строки отдельно не схлопываем: chunk_text режет по любой серии переводов строк
+    body = escape_html(raw[start:]).rstrip()
+    if not body: return html_title
+    return "".join([html_title, "\n\n", body])
+
+_WM_EXECUTOR: Optional[Executor] = None
+
+def _get_wm_executor() -> Executor:
+    """Пул создается при первом альбоме, а не при импорте (дочерние процессы импортируют модуль заново)."""
+    global _WM_EXECUTOR
+    if _WM_EXECUTOR is None:
+        if WATERMARK_EXECUTOR == "process":
+            # Пул создается посреди запуска, когда уже работают потоки to_thread: fork многопоточного
+            # процесса может повиснуть, поэтому дочерние процессы стартуют через forkserver
+            _WM_EXECUTOR = ProcessPoolExecutor(max_workers=WATERMARK_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+        else:
+            _WM_EXECUTOR = ThreadPoolExecutor(max_workers=WATERMARK_WORKERS)
+    return _WM_EXECUTOR
+
+@functools.lru_cache(maxsize=64)
+def _get_watermark(new_wm_width: int) -> Tuple[Image.Image, Image.Image]:
+    """Водяной знак нужной ширины как пара (RGB, маска) для paste() на RGB-фото (кэш по ширине знака)."""
+    watermark_img = _WATERMARK_SRC
+    wm_width, wm_height = watermark_img.size
+    new_wm_height = int(wm_height * (new_wm_width / wm_width))
+    
+    # Знак маленький (<500px), качество LANCZOS тут не заметно
+    resample_filter = getattr(Image.Resampling, "BILINEAR", Image.BILINEAR)
+    watermark_img = watermark_img.resize((new_wm_width, new_wm_height), resample=resample_filter)
+    # Так же, как раньше на прозрачном слое: знак, наложенный сам на себя по маске —
+    # сохраняет прежний вид полупрозрачных краев
+    tile = Image.new("RGBA", watermark_img.size, (0, 0, 0, 0))
+    tile.paste(watermark_img, (0, 0), watermark_img)
+    # Каналы делим один раз здесь, а не при каждом наложении
+    return tile.convert("RGB"), tile.getchannel("A")
+
+def _save_photo(img: Image.Image, out_path: Path):
+    """Сохраняет RGB-изображение в WATERMARK_FORMAT (колеса Pillow уже собраны с libjpeg-turbo и libwebp)."""
+    if WATERMARK_FORMAT == "WEBP":
+        img.save(out_path, format='WEBP', quality=WEBP_QUALITY, method=4)
+        return
+    # Кодирование идет в фоне, пока отправляется предыдущая статья, а заливка — на критическом пути:
+    # оптимальные таблицы Хаффмана и progressive дают ~10-12% меньше байт за несколько мс CPU
+    img.save(out_path, format='JPEG', quality=JPEG_QUALITY, subsampling=2, optimize=True, progressive=True)
+
+def apply_watermark(img_path: Path, scale: float, out_path: Path) -> bool:
+    """Накладывает водяной знак и пишет фото в out_path; False — фото пропускается."""
     try:
-        base_img = Image.open(img_path).convert("RGBA")
-        base_width, _ = base_img.size
-        watermark_path = Path(__file__).parent / "watermark.png"
-        
-        if not watermark_path.exists():
-            img_byte_arr = BytesIO()
-            base_img.convert("RGB").save(img_byte_arr, format='JPEG', quality=90)
-            return img_byte_arr.getvalue()
-
-        watermark_img = Image.open(watermark_path).convert("RGBA")
-        wm_width, wm_height = watermark_img.size
-        new_wm_width = int(base_width * scale)
-        if new_wm_width <= 0: new_wm_width = 1
-        new_wm_height = int(wm_height * (new_wm_width / wm_width))
-        
-        resample_filter = getattr(Image.Resampling, "LANCZOS", Image.LANCZOS)
-        watermark_img = watermark_img.resize((new_wm_width, new_wm_height), resample=resample_filter)
-        
-        overlay = Image.new("RGBA", base_img.size, (0, 0, 0, 0))
-        padding = int(base_width * 0.02)
-        position = (base_width - new_wm_width - padding, padding)
-        overlay.paste(watermark_img, position, watermark_img)
-        
-        composite_img = Image.alpha_composite(base_img, overlay).convert("RGB")
-        img_byte_arr = BytesIO()
-        composite_img.save(img_byte_arr, format='JPEG', quality=90)
-        return img_byte_arr.getvalue()
+        # Файл и декодированные пиксели освобождаем сразу, не дожидаясь сборщика мусора
+        with Image.open(img_path) as src:
+            # Для JPEG libjpeg декодирует сразу в 1/2, 1/4... без полного прохода IDCT
+            if src.format == "JPEG":
+                src.draft("RGB", (DRAFT_PHOTO_SIDE, DRAFT_PHOTO_SIDE))
+            # Фото держим в RGB (3 байта на пиксель): альфа нужна только у водяного знака
+            base_img = src.convert("RGB")
+        with base_img:
+            # draft уменьшает только кратно 2 (и не трогает PNG) — доводим длинную сторону до MAX_PHOTO_SIDE,
+            # чтобы наложение и кодирование шли уже по маленькому кадру
+            base_img.thumbnail((MAX_PHOTO_SIDE, MAX_PHOTO_SIDE), resample=Image.Resampling.BILINEAR)
+            if _WATERMARK_SRC is not None:
+                base_width, _ = base_img.size
+                new_wm_width = int(base_width * scale)
+                if new_wm_width <= 0: new_wm_width = 1
+                wm_rgb, wm_mask = _get_watermark(new_wm_width)
+                padding = int(base_width * 0.02)
+                position = (base_width - wm_rgb.width - padding, padding)
+                # Смешиваем по маске только область знака, без полноразмерного слоя и alpha_composite
+                base_img.paste(wm_rgb, position, wm_mask)
+            _save_photo(base_img, out_path)
+        return True
     except Exception as e:
         logging.error(f"Не удалось наложить водяной знак на {img_path}: {e}")
-        return b""
+        return False
+
+class AsyncRateLimiter:
+    """Token bucket для asyncio: не больше rate запросов за period секунд"""
+    def __init__(self, rate: int, period: float):
+        self.rate, self.period = rate, period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            wait = self.resume_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            while True:
+                # Пополняем ведро пропорционально прошедшему времени
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.period / self.rate)
+
+    def pause(self, seconds: float):
+        """Сервер попросил подождать (429): все следующие acquire() ждут до конца паузы"""
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        # За паузу ведро не копится: после нее продолжаем в обычном темпе, а не пачкой
+        self.tokens = 0.0
+        self.updated = self.resume_at
+
+CHAT_LIMITER = AsyncRateLimiter(*CHAT_RATE)
+GLOBAL_LIMITER = AsyncRateLimiter(*GLOBAL_RATE)
+
+def _backoff_delay(attempt: int) -> float:
+    """Экспоненциальная пауза с полным джиттером: в среднем как прежние 5/10 с, но повторы не синхронны."""
+    return random.uniform(0, min(BACKOFF_CAP, RETRY_DELAY * 2 ** attempt))
 
 async def _post_with_retry(client: httpx.AsyncClient, method: str, url: str, data: Dict[str, Any], files: Optional[Dict[str, Any]] = None) -> bool:
     for attempt in range(1, MAX_RETRIES + 1):
+        # Темп задают лимитеры, а 429 с retry_after ниже остается страховкой
+        await CHAT_LIMITER.acquire()
+        await GLOBAL_LIMITER.acquire()
         try:
-            resp = await client.request(method, url, data=data, files=files, timeout=HTTPX_TIMEOUT)
+            resp = await client.request(method, url, data=data, files=files)
             resp.raise_for_status()
             return True
         except HTTPStatusError as e:
             if e.response.status_code == 429:
-                retry_after = int(e.response.json().get("parameters", {}).get("retry_after", RETRY_DELAY))
+                retry_after = int(e.response.json().get("parameters", {}).get("retry_after")
+                                  or e.response.headers.get("retry-after") or RETRY_DELAY)
                 logging.warning(f"🐢 Rate limit. Ждем {retry_after} сек...")
-                await asyncio.sleep(retry_after)
+                # Пауза общая: ее выдержит и повтор, и следующее сообщение, даже если попытки кончились
+                CHAT_LIMITER.pause(retry_after)
             elif 400 <= e.response.status_code < 500:
                 logging.error(f"❌ Ошибка Telegram {e.response.status_code}: {e.response.text}")
                 return False
             else:
                 logging.warning(f"⚠️ Ошибка сервера {e.response.status_code}. Попытка {attempt}/{MAX_RETRIES}...")
-                await asyncio.sleep(RETRY_DELAY * attempt)
+                # После последней попытки ждать нечего — сразу сообщаем о неудаче
+                if attempt < MAX_RETRIES: await asyncio.sleep(_backoff_delay(attempt))
         except (ReadTimeout, httpx.RequestError) as e:
             logging.warning(f"⏱️ Ошибка сети: {e}. Попытка {attempt}/{MAX_RETRIES}...")
-            await asyncio.sleep(RETRY_DELAY * attempt)
+            if attempt < MAX_RETRIES: await asyncio.sleep(_backoff_delay(attempt))
     return False
 
-async def send_media_group(client: httpx.AsyncClient, token: str, chat_id: str, images: List[Path], watermark_scale: float, silent: bool = True) -> bool:
-    url = f"https://api.telegram.org/bot{token}/sendMediaGroup"
+async def prepare_album(images: List[Path], watermark_scale: float, out_dir: Path) -> Tuple[List[Dict[str, str]], Dict[str, Path]]:
+    """Накладывает водяные знаки на фото альбома (результат — файлы в out_dir) и возвращает (media, files) для sendMediaGroup."""
     media, files = [], {}
+    if not images: return media, files
+    out_dir.mkdir(parents=True, exist_ok=True)
     loop = asyncio.get_running_loop()
+    executor = _get_wm_executor()
     
-    for idx, img_path in enumerate(images[:10]):
-        image_bytes = await loop.run_in_executor(None, apply_watermark, img_path, watermark_scale)
-        if image_bytes:
+    # Все фото альбома обрабатываются параллельно, порядок сохраняется gather'ом
+    out_paths = [out_dir / f"photo{idx}{PHOTO_EXT}" for idx in range(len(images[:10]))]
+    results = await asyncio.gather(*(loop.run_in_executor(executor, apply_watermark, img_path, watermark_scale, out_path) for img_path, out_path in zip(images, out_paths)))
+    for idx, ok in enumerate(results):
+        if ok:
             key = f"photo{idx}"
-            files[key] = (f"img_{idx}.jpg", image_bytes, "image/jpeg")
+            files[key] = out_paths[idx]
             media.append({"type": "photo", "media": f"attach://{key}"})
-            
+    return media, files
+
+async def prepare_article(article: Dict[str, Any], watermark_scale: float, work_dir: Path) -> Tuple[Tuple[List[Dict[str, str]], Dict[str, Path]], List[str]]:
+    """Готовит альбом и текстовые чанки статьи; фото и текст обрабатываются одновременно."""
+    album, raw_text = await asyncio.gather(
+        prepare_album(article["image_paths"], watermark_scale, work_dir / str(article["id"])),
+        asyncio.to_thread(article["text_path"].read_text, encoding="utf-8"),
+    )
+    full_html = _prepare_body(article["html_title"], article["original_title"], raw_text)
+    return album, chunk_text(full_html)
+
+async def _produce_articles(articles: List[Dict[str, Any]], watermark_scale: float, work_dir: Path, queue: asyncio.Queue):
+    """Заранее готовит статьи по порядку; ошибка подготовки передается отправителю вместо результата."""
+    for article in articles:
+        try:
+            prepared = await prepare_article(article, watermark_scale, work_dir)
+        except Exception as e:
+            prepared = e
+        await queue.put((article, prepared))
+
+async def send_media_group(client: httpx.AsyncClient, token: str, chat_id: str, album: Tuple[List[Dict[str, str]], Dict[str, Path]], silent: bool = True) -> bool:
+    url = f"/bot{token}/sendMediaGroup"
+    media, paths = album
     if not media: return False
     
     data = {
@@ -127,10 +305,14 @@ async def send_media_group(client: httpx.AsyncClient, token: str, chat_id: str,
         "media": json.dumps(media),
         "disable_notification": silent  # Если True — звука нет
     }
-    return await _post_with_retry(client, "POST", url, data, files)
+    # httpx читает открытые файлы кусками прямо при отправке (и перематывает их на повторах),
+    # поэтому готовые фото не держим в памяти целиком
+    with contextlib.ExitStack() as stack:
+        files = {key: (path.name, stack.enter_context(open(path, "rb")), PHOTO_MIME) for key, path in paths.items()}
+        return await _post_with_retry(client, "POST", url, data, files)
 
-async def send_message(client: httpx.AsyncClient, token: str, chat_id: str, text: str, silent: bool = True, **kwargs) -> bool:
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
+async def send_message(client: httpx.AsyncClient, token: str, chat_id: str, text: str, silent: bool = True, reply_markup_json: Optional[str] = None) -> bool:
+    url = f"/bot{token}/sendMessage"
     data = {
         "chat_id": chat_id, 
         "text": text, 
@@ -138,36 +320,66 @@ async def send_message(client: httpx.AsyncClient, token: str, chat_id: str, text
         "disable_web_page_preview": True,
         "disable_notification": silent  # Если True — звука нет
     }
-    if kwargs.get("reply_markup"):
-        data["reply_markup"] = json.dumps(kwargs["reply_markup"])
+    if reply_markup_json:
+        data["reply_markup"] = reply_markup_json
     return await _post_with_retry(client, "POST", url, data)
 
-def load_posted_ids(state_file: Path) -> Set[str]:
-    if not state_file.is_file(): return set()
-    try:
-        data = json.loads(state_file.read_text(encoding="utf-8"))
-        if not isinstance(data, list): return set()
-        return {str(item) for item in data if item is not None}
-    except Exception: return set()
-
-def save_posted_ids(all_ids_to_save: Set[str], state_file: Path) -> None:
-    """Атомарно сохраняет ID в файл, обрезая историю до лимита."""
-    state_file.parent.mkdir(parents=True, exist_ok=True)
+def _dir_article_id(name: str) -> Optional[int]:
+    """ID статьи из имени папки "{id}_{slug}" (так их называет main.py)."""
+    prefix = name.partition("_")[0]
+    return int(prefix) if prefix.isdigit() else None
+
+def _load_article(d: Path, posted_ids: Set[int]) -> Optional[Dict[str, Any]]:
+    """Читает meta.json папки и собирает статью к публикации (None — пропустить)."""
+    meta_file = d / "meta.json"
+    if not meta_file.is_file(): return None
     try:
-        # Преобразуем в int для правильной сортировки (99 < 100)
-        sorted_ids = sorted([int(i) for i in all_ids_to_save])
-        if len(sorted_ids) > MAX_POSTED_RECORDS:
-            sorted_ids = sorted_ids[-MAX_POSTED_RECORDS:]
+        art_meta = orjson.loads(meta_file.read_bytes())
+        article_id = int(art_meta["id"])
+        if article_id in posted_ids: return None
+        
+        text_file = art_meta.get("text_file")
+        if not text_file or not (d / text_file).is_file(): return None
         
-        # Сохраняем через временный файл, чтобы не повредить основной при сбое
-        temp_file = state_file.with_suffix(".tmp")
-        with temp_file.open("w", encoding="utf-8") as f:
-            json.dump(sorted_ids, f, ensure_ascii=False, indent=2)
-        temp_file.replace(state_file)
+        # Ищем картинки в папке images: scandir без отдельного is_dir() и Path на каждую запись.
+        # Если main.py перечислил файлы в meta["images"], берем только их (без остатков прошлых загрузок)
+        listed = {Path(p).name for p in art_meta.get("images") or []}
+        valid_imgs = []
+        try:
+            with os.scandir(d / "images") as it:
+                valid_imgs = sorted(
+                    Path(e.path) for e in it
+                    if (not listed or e.name in listed) and os.path.splitext(e.name)[1].lower() in IMAGE_EXTS
+                )
+        except (FileNotFoundError, NotADirectoryError): pass
         
-        logging.info(f"💾 История обновлена: {len(sorted_ids)} ID сохранено.")
+        return {
+            "id": article_id,
+            "html_title": f"<b>{escape_html(art_meta.get('title', '').strip())}</b>",
+            "text_path": d / text_file,
+            "image_paths": valid_imgs,
+            "original_title": art_meta.get('title', '').strip()
+        }
     except Exception as e:
-        logging.error(f"Ошибка при сохранении posted.json: {e}")
+        logging.warning(f"Ошибка чтения метаданных в {d}: {e}")
+        return None
+
+def _scan_articles(parsed_root: Path, posted_ids: Set[int]) -> List[Dict[str, Any]]:
+    """Собирает неопубликованные статьи из parsed_root, отсортированные по ID."""
+    articles_to_post = []
+    if parsed_root.is_dir():
+        # scandir отдает тип записи без лишнего stat(); порядок не важен — ниже сортируем по ID
+        with os.scandir(parsed_root) as it:
+            entries = [e for e in it if e.is_dir()]
+        # Опубликованные отсекаем по имени папки, не открывая meta.json
+        dirs = [Path(e.path) for e in entries if _dir_article_id(e.name) not in posted_ids]
+        # Мелкие чтения упираются в задержку syscalls — перекрываем их потоками
+        with ThreadPoolExecutor(max_workers=META_WORKERS) as ex:
+            articles_to_post = [a for a in ex.map(lambda d: _load_article(d, posted_ids), dirs) if a]
+
+    # Сортируем: сначала публикуем более старые (меньший ID)
+    articles_to_post.sort(key=lambda x: x["id"])
+    return articles_to_post
 
 async def main(parsed_dir: str, state_path: str, limit: Optional[int], watermark_scale: float):
     token, chat_id = os.getenv("TELEGRAM_TOKEN"), os.getenv("TELEGRAM_CHANNEL")
@@ -179,36 +391,8 @@ async def main(parsed_dir: str, state_path: str, limit: Optional[int], watermark
     posted_ids = load_posted_ids(state_file)
     logging.info(f"Загружено {len(posted_ids)} опубликованных ID из истории.")
     
-    articles_to_post = []
-    if parsed_root.is_dir():
-        for d in sorted(parsed_root.iterdir()):
-            meta_file = d / "meta.json"
-            if d.is_dir() and meta_file.is_file():
-                try:
-                    art_meta = json.loads(meta_file.read_text(encoding="utf-8"))
-                    article_id = str(art_meta.get("id"))
-                    
-                    if article_id and article_id not in posted_ids:
-                        text_file = art_meta.get("text_file")
-                        if text_file and (d / text_file).is_file():
-                            # Ищем картинки в папке images
-                            images_dir = d / "images"
-                            valid_imgs = []
-                            if images_dir.is_dir():
-                                valid_imgs = sorted([p for p in images_dir.iterdir() if p.suffix.lower() in {".jpg", ".jpeg", ".png"}])
-                            
-                            articles_to_post.append({
-                                "id": article_id,
-                                "html_title": f"<b>{escape_html(art_meta.get('title', '').strip())}</b>",
-                                "text_path": d / text_file,
-                                "image_paths": valid_imgs,
-                                "original_title": art_meta.get('title', '').strip()
-                            })
-                except Exception as e:
-                    logging.warning(f"Ошибка чтения метаданных в {d}: {e}")
-
-    # Сортируем: сначала публикуем более старые (меньший ID)
-    articles_to_post.sort(key=lambda x: int(x["id"]))
+    # Обход папок блокирующий — уводим его из event loop в поток
+    articles_to_post = await asyncio.to_thread(_scan_articles, parsed_root, posted_ids)
     
     if not articles_to_post:
         logging.info("🔍 Новых статей для публикации не найдено.")
@@ -216,60 +400,63 @@ async def main(parsed_dir: str, state_path: str, limit: Optional[int], watermark
 
     logging.info(f"Найдено {len(articles_to_post)} статей для отправки.")
 
-    async with httpx.AsyncClient() as client:
-        # Определяем, сколько статей мы РЕАЛЬНО будем постить
-        to_process = articles_to_post[:limit] if limit else articles_to_post
-        total_to_send = len(to_process)
-        sent_count = 0
+    # Фото с водяным знаком пишутся во временную папку и оттуда же отправляются
+    with tempfile.TemporaryDirectory(prefix="poster_", ignore_cleanup_errors=True) as tmp:
+        work_dir = Path(tmp)
+        async with httpx.AsyncClient(base_url=TELEGRAM_API, http2=True, limits=HTTPX_LIMITS, timeout=HTTPX_TIMEOUT) as client:
+            # Определяем, сколько статей мы РЕАЛЬНО будем постить
+            to_process = articles_to_post[:limit] if limit else articles_to_post
+            total_to_send = len(to_process)
+            sent_count = 0
+        
+            # Подготовка следующих статей (водяные знаки, текст) идет в фоне, пока отправляется текущая
+            queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+            producer = asyncio.create_task(_produce_articles(to_process, watermark_scale, work_dir, queue))
         
-        for idx, article in enumerate(to_process):
-            # Проверяем: это самая последняя статья в текущем запуске?
-            is_last_article = (idx == total_to_send - 1)
-            
-            logging.info(f"🚀 Публикация ID={article['id']} (Статья {idx+1}/{total_to_send})...")
             try:
-                # 1. Альбом ВСЕГДА шлем тихо
-                if article["image_paths"]:
-                    await send_media_group(client, token, chat_id, article["image_paths"], watermark_scale, silent=True)
+                for idx in range(total_to_send):
+                    article, prepared = await queue.get()
+                    # Проверяем: это самая последняя статья в текущем запуске?
+                    is_last_article = (idx == total_to_send - 1)
                 
-                raw_text = article["text_path"].read_text(encoding="utf-8")
-                cleaned_text = raw_text.lstrip()
-                if cleaned_text.startswith(article["original_title"]):
-                    cleaned_text = cleaned_text[len(article["original_title"]):].lstrip()
+                    logging.info(f"🚀 Публикация ID={article['id']} (Статья {idx+1}/{total_to_send})...")
+                    try:
+                        if isinstance(prepared, Exception): raise prepared
+                        album, chunks = prepared
+                    
+                        # 1. Альбом ВСЕГДА шлем тихо
+                        if article["image_paths"]:
+                            await send_media_group(client, token, chat_id, album, silent=True)
 
-                full_html = f"{article['html_title']}\n\n{escape_html(cleaned_text)}"
-                full_html = re.sub(r'\n{3,}', '\n\n', full_html).strip()
-                chunks = chunk_text(full_html)
+                        for c_idx, chunk in enumerate(chunks):
+                            is_last_chunk = (c_idx == len(chunks) - 1)
+                        
+                            # Звук включится ТОЛЬКО если это последняя статья И последний чанк в ней
+                            should_be_silent = not (is_last_article and is_last_chunk)
+                        
+                            reply_markup_json = REPLY_MARKUP_JSON if is_last_chunk else None
+                        
+                            if not await send_message(client, token, chat_id, chunk, silent=should_be_silent, reply_markup_json=reply_markup_json):
+                                raise Exception(f"Не удалось отправить текст статьи {article['id']}")
 
-                for c_idx, chunk in enumerate(chunks):
-                    is_last_chunk = (c_idx == len(chunks) - 1)
+                        logging.info(f"✅ Статья ID={article['id']} успешно опубликована.")
+                        posted_ids.add(article['id'])
+                        append_posted_ids([article['id']], state_file)
                     
-                    # Звук включится ТОЛЬКО если это последняя статья И последний чанк в ней
-                    should_be_silent = not (is_last_article and is_last_chunk)
-                    
-                    reply_markup = { 
-                        "inline_keyboard": [[ 
-                            {"text": "💵 Обмен валют", "url": "https://t.me/mister1dollar"}, 
-                            {"text": "✍️ Отзывы", "url": "https://t.me/feedback1dollar"} 
-                        ]]
-                    } if is_last_chunk else None
-                    
-                    if not await send_message(client, token, chat_id, chunk, silent=should_be_silent, reply_markup=reply_markup):
-                        raise Exception(f"Не удалось отправить текст статьи {article['id']}")
-                    
-                    await asyncio.sleep(0.5)
+                        sent_count += 1
+                        await asyncio.sleep(float(os.getenv("POST_DELAY", DEFAULT_DELAY)))
 
-                logging.info(f"✅ Статья ID={article['id']} успешно опубликована.")
-                posted_ids.add(article['id'])
-                save_posted_ids(posted_ids, state_file)
-                
-                sent_count += 1
-                await asyncio.sleep(float(os.getenv("POST_DELAY", DEFAULT_DELAY)))
-
-            except Exception as e:
-                logging.error(f"❌ Сбой при публикации ID={article['id']}: {e}")
-                continue
+                    except Exception as e:
+                        logging.error(f"❌ Сбой при публикации ID={article['id']}: {e}")
+                        continue
+                    finally:
+                        # Готовые фото статьи больше не нужны
+                        shutil.rmtree(work_dir / str(article["id"]), ignore_errors=True)
+            finally:
+                producer.cancel()
 
+    # Полный снимок posted.json — раз за запуск, только если что-то опубликовали и журнал разросся
+    if sent_count: compact_posted_ids(state_file)
     logging.info(f"🏁 Сессия завершена. Опубликовано статей: {sent_count}")
 
 if __name__ == "__main__":
@@ -279,4 +466,11 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--limit", type=int, default=None)
     parser.add_argument("--watermark-scale", type=float, default=WATERMARK_SCALE)
     args = parser.parse_args()
-    asyncio.run(main(args.parsed_dir, args.state_file, args.limit, args.watermark_scale))
+    # uvloop (libuv) быстрее стандартного цикла на сокетах и таймерах; на Windows его нет
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main(args.parsed_dir, args.state_file, args.limit, args.watermark_scale))